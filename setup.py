@@ -19,10 +19,14 @@ VERSION = '0.5.1'
 
 # What packages are required for this module to be executed?
 REQUIRED = [
-    "numpy", "ome_types", "h5py", "bioio", "typer"
+    # serialize_ome uses the xsdata bindings of ome_types 0.4
+    "numpy", "ome_types~=0.4.5", "h5py", "tifffile", "typer"
 ]
 
-EXTRAS = {}
+EXTRAS = {
+    "numba": ["numba"],
+    "imagecodecs": ["imagecodecs"],
+}
 
 here = os.path.abspath(os.path.dirname(__file__))
 
@@ -1 +1,24 @@
-from .tcf_to_ometiff import *
+from importlib import import_module
+
+# the functions of the parser module, which the package exports (also for "from tcf_to_ometiff import *")
+__all__ = [
+    "def_mic", "def_det", "def_obj", "def_light_source", "def_instr", "def_stagelabel", "def_channel", "def_fl_channel",
+    "def_experimenter", "def_experiment", "def_project", "def_map_annotation", "def_annotations", "def_plane",
+    "build_ome_xml", "parse_key_value_lines", "read_basic_user_config", "def_ome_basic_md", "create_overall_config",
+    "read_image_config", "convert_tiling_value", "read_tiling_info", "is_fl_channel_enabled", "define_image_metadata",
+    "get_chunk_cache_bytes", "open_tcf", "build_tcf_cache", "get_tcf_cache", "take_scratch", "iter_image_stack",
+    "prefetch_blocks", "rescale_to_uint16_numpy", "get_rescale_kernel", "rescale_to_uint16", "iter_rescaled_to_uint16",
+    "read_timesteps", "read_2dmip", "read_2d", "read_bf", "read_3d", "read_2dflmip", "read_3dfl", "get_xml_serializer",
+    "serialize_ome", "get_tiff_compression", "get_tiff_compression_args", "write_ome_tiff", "transform_tcf",
+    "is_converted", "transform_folder_worker", "transform_folder"
+]
+
+
+def __getattr__(name):
+    # the parser module is only imported on first use, so that starting the CLI does not pay for importing ome_types,
+    # h5py and tifffile before the arguments are parsed
+    return getattr(import_module(".tcf_to_ometiff", __name__), name)
+
+
+def __dir__():
+    return __all__
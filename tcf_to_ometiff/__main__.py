@@ -0,0 +1,3 @@
+from tcf_to_ometiff.cli import main
+
+main()
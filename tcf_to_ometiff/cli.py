@@ -1,12 +1,43 @@
-import typer
+from typing import Optional
 
-import tcf_to_ometiff
+import typer
 
+# the parser module imports ome_types, h5py and tifffile, which take most of the start-up time of the CLI. It is only
+# imported inside the commands, so that --help and invalid arguments return immediately
 main = typer.Typer()
 
 
+def get_phase_range(phase_min, phase_max):
+    """Combine the phase range CLI options into the phase_range argument of the parser.
+
+    :param phase_min: Phase value mapped to 0 or None
+    :param phase_max: Phase value mapped to 65535 or None
+    :return: tuple (phase_min, phase_max) or None if the phasemaps are kept as float
+
+    """
+    if phase_min is None and phase_max is None:
+        return None
+    if phase_min is None or phase_max is None or phase_min >= phase_max:
+        raise typer.BadParameter("--phase-min and --phase-max must be given together with phase-min < phase-max")
+    return phase_min, phase_max
+
+
 @main.command()
-def parse_multiple(top_folder: str, config_file_path: str, output_xml: bool = False):
+def parse_multiple(
+    top_folder: str,
+    config_file_path: str,
+    output_xml: bool = False,
+    processes: int = typer.Option(0, min=0),
+    threads: bool = False,
+    force: bool = False,
+    phase_min: Optional[float] = None,
+    phase_max: Optional[float] = None,
+    cache: bool = False,
+    compression: str = "zlib",
+    compression_level: int = 1,
+    mip_compression: Optional[str] = None,
+    mip_compression_level: Optional[int] = None
+):
     """CLI to parse images stored in subfolders of a top folder. This is the
     standard TomoStudio case when on each date a new top folder is created that
     has one subfolder for each snapshot. The parsed OME-TIFF images are stored
@@ -15,13 +46,44 @@ def parse_multiple(top_folder: str, config_file_path: str, output_xml: bool = Fa
     :param top_folder: Relative or absolute file path to top folder
     :param config_file_path: Relative or absolute file path to csv file with project OMERO metadata
     :param output_xml: If true, output the ome-xml file alongside the ome-tiff file
+    :param processes: Maximum number of folders parsed in parallel (0: number of CPUs)
+    :param threads: If true, parse two folders at a time in threads instead of worker processes
+    :param force: If true, also parse folders that already contain an OME-TIFF newer than the TCF file
+    :param phase_min: Phase value mapped to 0 if 2D phasemaps are rescaled to uint16 (requires phase_max)
+    :param phase_max: Phase value mapped to 65535 if 2D phasemaps are rescaled to uint16 (requires phase_min)
+    :param cache: If true, read the images from re-chunked copies of the TCF files that are kept for repeated runs
+    :param compression: Compression of the OME-TIFFs, e.g. zlib, zstd (requires imagecodecs) or none
+    :param compression_level: Compression level, higher levels give smaller files but take longer
+    :param mip_compression: Compression of the maximum intensity projections if it should differ, e.g. none
+    :param mip_compression_level: Level of the MIP compression (default: the default level of the codec)
 
     """
-    tcf_to_ometiff.transform_folder(top_folder, config_file_path, output_xml)
+    import tcf_to_ometiff
+
+    failed = tcf_to_ometiff.transform_folder(
+        top_folder, config_file_path, output_xml, processes=processes or None, use_threads=threads, force=force,
+        phase_range=get_phase_range(phase_min, phase_max), use_cache=cache, compression=compression,
+        compression_level=compression_level, mip_compression=mip_compression,
+        mip_compression_level=mip_compression_level
+    )
+    if len(failed) > 0:
+        # the failed folders are logged by the parser, the exit code lets scripts notice them
+        raise typer.Exit(code=1)
 
 
 @main.command()
-def parse(folder: str, config_file_path: str, output_xml: bool = False):
+def parse(
+    folder: str,
+    config_file_path: str,
+    output_xml: bool = False,
+    phase_min: Optional[float] = None,
+    phase_max: Optional[float] = None,
+    cache: bool = False,
+    compression: str = "zlib",
+    compression_level: int = 1,
+    mip_compression: Optional[str] = None,
+    mip_compression_level: Optional[int] = None
+):
     """CLI to parse an image in a folder that has the same name as the folder and
     additionally ends with .TCF. The parsed OME-TIFF image is stored in the
     same folder.
@@ -29,10 +91,22 @@ def parse(folder: str, config_file_path: str, output_xml: bool = False):
     :param folder: Relative or absolute file path to folder containing image
     :param config_file_path: Relative or absolute file path to csv file with project OMERO metadata
     :param output_xml: If true, output the ome-xml file alongside the ome-tiff file
+    :param phase_min: Phase value mapped to 0 if 2D phasemaps are rescaled to uint16 (requires phase_max)
+    :param phase_max: Phase value mapped to 65535 if 2D phasemaps are rescaled to uint16 (requires phase_min)
+    :param cache: If true, read the image from a re-chunked copy of the TCF file that is kept for repeated runs
+    :param compression: Compression of the OME-TIFF, e.g. zlib, zstd (requires imagecodecs) or none
+    :param compression_level: Compression level, higher levels give smaller files but take longer
+    :param mip_compression: Compression of the maximum intensity projections if it should differ, e.g. none
+    :param mip_compression_level: Level of the MIP compression (default: the default level of the codec)
 
     """
+    import tcf_to_ometiff
+
     overall_md = tcf_to_ometiff.create_overall_config(config_file_path)
-    tcf_to_ometiff.transform_tcf(folder, overall_md, output_xml)
+    tcf_to_ometiff.transform_tcf(
+        folder, overall_md, output_xml, get_phase_range(phase_min, phase_max), cache, compression, compression_level,
+        mip_compression=mip_compression, mip_compression_level=mip_compression_level
+    )
 
 
 if __name__ == "__main__":
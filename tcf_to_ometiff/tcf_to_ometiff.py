@@ -1,13 +1,66 @@
-from os.path import join, basename, isdir
-from os import listdir
+import csv
+import io
+from os.path import join, basename, getmtime, getsize
+from os import scandir, cpu_count, replace, remove
 from datetime import datetime
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import queue
+import threading
 
 import numpy as np
 import logging
 
-from ome_types import model
+from ome_types import model, to_xml
 import h5py
-from bioio import writers
+import tifffile
+
+# HDF5 raw data chunk cache used when reading TCF files. The HDF5 default of 1 MiB is smaller than a single chunk of
+# a typical 3D HT volume, which makes HDF5 decompress the same chunk again for every partial read. HDF5 gives every
+# open dataset its own cache of this size, so it is kept at about one timestep (see get_chunk_cache_bytes)
+TCF_CHUNK_CACHE_MIN_BYTES = 1024 * 1024  # the HDF5 default
+TCF_CHUNK_CACHE_MAX_BYTES = 64 * 1024 * 1024
+TCF_CHUNK_CACHE_CHUNKS = 2  # the cache holds this many of the largest chunks of the file, but not more than a timestep
+TCF_CHUNK_CACHE_SLOTS = 1009  # prime number, ideally ~100 times the number of chunks that fit into the cache
+TCF_CHUNK_CACHE_W0 = 0.75
+# HDF5 page buffer used for TCF files. Files written with the paged file space strategy then serve the many small
+# metadata reads (group listings, attributes) from page-aligned block reads; it has no effect on other files
+TCF_PAGE_BUFFER_BYTES = 16 * 1024 * 1024
+TCF_PAGE_BUFFER_MIN_META_PERC = 50
+# TCF files up to this size are read into memory with one sequential read when opened (HDF5 core driver) instead of
+# one read per chunk and metadata block, which pays off on network storage
+TCF_CORE_DRIVER_MAX_BYTES = 256 * 1024 * 1024
+# edge length of the tiles in the OME-TIFF. Edge tiles are padded, so a modest size keeps the padding of the typical
+# 1172 px HT images small while still letting viewers read regions of a plane without decompressing all of it
+TIFF_TILE_SIZE = 256
+# lossless compression of the OME-TIFF. With the predictor (differences of neighboring pixels) zlib level 1 compresses
+# uint16 microscopy images better than level 6 without it, at about a third of the time. If imagecodecs is installed,
+# tifffile compresses zlib with libdeflate, which is about twice as fast as the zlib module at the same level
+TIFF_COMPRESSION = "zlib"
+TIFF_COMPRESSION_LEVEL = 1
+# lossless compressions of tifffile the OME-TIFF can be written with. The others are lossy (e.g. jpeg, webp) or only
+# exist for reading camera formats
+TIFF_LOSSLESS_COMPRESSIONS = ("zlib", "deflate", "adobe_deflate", "zstd", "lzma", "lzw", "packbits")
+# imaging modalities that are maximum intensity projections. They only have one plane per timestep, so they can be
+# stored with a faster compression than the stacks (see mip_compression of transform_tcf)
+MIP_MODALITIES = ("2DMIP", "2DFLMIP")
+# number of timesteps of an image in memory while writing: the one being compressed and the next one read in the
+# background (see prefetch_blocks); 1 turns the overlap off
+PREFETCH_BLOCKS = 2
+
+OME_NAMESPACE = "http://www.openmicroscopy.org/Schemas/OME/2016-06"
+
+# config.dat counter of the acquired images for each imaging modality in the TCF file
+MODALITY_IMAGE_COUNTERS = {
+    "2DMIP": "Images HT3D",
+    "2D": "Images HT2D",
+    "3D": "Images HT3D",
+    "BF": "Images BF",
+    "2DFLMIP": "Images FL3D",
+    "3DFL": "Images FL3D"
+}
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -16,6 +69,7 @@ logging.basicConfig(
 )
 
 
+@lru_cache(maxsize=None)
 def def_mic(sn, mic_model, lot=None):
     """Create ome-types microscope for use in OME-XML
 
@@ -33,6 +87,7 @@ def def_mic(sn, mic_model, lot=None):
     )
 
 
+@lru_cache(maxsize=None)
 def def_det(det_id):
     """Create ome-types detector for use in OME-XML
 
@@ -42,6 +97,7 @@ def def_det(det_id):
     return model.Detector(id=det_id, type="CMOS")
 
 
+@lru_cache(maxsize=None)
 def def_obj(obj_id, lens_na, lens_magn):
     """Create ome-types objective for use in OME-XML
 
@@ -55,6 +111,7 @@ def def_obj(obj_id, lens_na, lens_magn):
     )
 
 
+@lru_cache(maxsize=None)
 def def_light_source(light_source_id):
     """Create ome-types light source (HT laser) for use in OME-XML
 
@@ -98,7 +155,8 @@ def def_instr(instr_id, microscope, detectors, lasers, leds):
 
 
 def def_stagelabel(x_stage, y_stage, offset, ht_height, fl_height):
-    z_shift = np.round(offset - fl_height/2, 2)
+    # plain float arithmetic, the values are scalars
+    z_shift = round(float(offset) - float(fl_height)/2, 2)
 
     sl = model.StageLabel(
         name="Fluorescence Image Z Shift",
@@ -112,6 +170,19 @@ def def_stagelabel(x_stage, y_stage, offset, ht_height, fl_height):
     return sl
 
 
+# FL channel number -> color, excitation wavelength, light source settings and the config.dat keys of the emission
+# wavelength and the fluorophore; built once at import instead of on every def_channel call
+FL_CHANNELS = {
+    str(i): (
+        color,
+        lambda_exc,
+        model.LightSourceSettings(id="LightSource:{}".format(i + 1), wavelength=lambda_exc),
+        "FLCH{}_Fluorophore_Emission".format(i),
+        "FLCH{}_Fluorophore_Name".format(i)
+    ) for i, (color, lambda_exc) in enumerate((("blue", 385), ("green", 470), ("red", 570)))
+}
+
+
 def def_channel(image_name, img_md=None):
     """Create ome-types channel for use in OME-XML
 
@@ -148,45 +219,35 @@ def def_channel(image_name, img_md=None):
         )
 
     else:
-        lambda_emi = img_md["FLCH{}_Fluorophore_Emission".format(image_name[2])]
-        fluor = img_md["FLCH{}_Fluorophore_Name".format(image_name[2])]
-
-        if image_name[2] == "0":
-            color = "blue"
-            lambda_exc = 385
-            settings = model.LightSourceSettings(
-                id="LightSource:1",
-                wavelength=lambda_exc
-            )
-        elif image_name[2] == "1":
-            color = "green"
-            lambda_exc = 470
-            settings = model.LightSourceSettings(
-                id="LightSource:2",
-                wavelength=lambda_exc
-            )
-        elif image_name[2] == "2":
-            color = "red"
-            lambda_exc = 570
-            settings = model.LightSourceSettings(
-                id="LightSource:3",
-                wavelength=lambda_exc
-            )
-        else:
-            print("Unknown image name: {}".format(image_name))
-        return model.Channel(
-            # id="Channel:{}".format(int(image_name[2])+2),
-            acquisition_mode="Other",
-            contrast_method="Fluorescence",
-            illumination_type="Transmitted",
-            name="Fluorescence {}".format(color),
-            light_source_settings=settings,
-            samples_per_pixel=1,
-            color=color,
-            excitation_wavelength=lambda_exc,
-            emission_wavelength=lambda_emi,
-            fluor=fluor
-        )
+        _, _, _, emission_key, fluor_key = FL_CHANNELS[image_name[2]]
+        return def_fl_channel(image_name[2], img_md[emission_key], img_md[fluor_key])
+
+
+@lru_cache(maxsize=None)
+def def_fl_channel(channel, lambda_emi, fluor):
+    """Create ome-types channel of a fluorescence channel. Runs of one setup share the emission wavelengths and
+    fluorophores, so the channels are created once and shared between images (transform_tcf copies them before
+    setting the ID).
+
+    :param channel: str: FL channel number
+    :param lambda_emi: emission wavelength from the image config
+    :param fluor: name of the fluorophore from the image config
+    :return: ome-types channel with "Fluorescence" as contrast method
+    """
+    color, lambda_exc, settings, _, _ = FL_CHANNELS[channel]
+    return model.Channel(
+        # id="Channel:{}".format(int(channel)+2),
+        acquisition_mode="Other",
+        contrast_method="Fluorescence",
+        illumination_type="Transmitted",
+        name="Fluorescence {}".format(color),
+        light_source_settings=settings,
+        samples_per_pixel=1,
+        color=color,
+        excitation_wavelength=lambda_exc,
+        emission_wavelength=lambda_emi,
+        fluor=fluor
+    )
 
 
 def def_experimenter(exper_id, email, inst, first_name, last_name, user_name):
@@ -231,6 +292,67 @@ def def_project(proj_id, proj_name, desc):
     return model.Project(id=proj_id, name=proj_name, description=desc)
 
 
+# (config.dat / tiling_info.txt key, annotation key) pairs of the values in the annotations of def_annotations
+OVERALL_ANNOTATION_KEYS = (
+    ("Medium_Name", "MediumName"),
+    ("Medium_RI", "MediumRI"),
+    ("Immersion_RI", "ImmersionRI"),
+    ("Annotation", "Annotation"),
+    ("SW Version", "TomoStudioVersion")
+)
+HT_ANNOTATION_KEYS = (
+    ("mapping sign", "HT_MappingSign"),
+    ("phase sign", "HT_PhaseSign"),
+    ("iteration", "HT_Iterations"),
+    ("Camera Shutter", "HT_ExposureTime"),
+    ("Camera Gain", "HT_Gain")
+)
+BF_ANNOTATION_KEYS = (
+    ("BF_Camera_Shutter", "BF_ExposureTime"),
+    ("BF_Light_Intensity", "BF_Intensity")
+)
+TILING_ANNOTATION_KEYS = (
+    ("tile_img_id", "Tiling_ClusterID"),
+    ("tile_total_images", "Tiling_TotalTilesInImage"),
+    ("tile_number", "Tiling_NumberInImage"),
+    ("tile_row", "Tiling_Row"),
+    ("tile_column", "Tiling_Column"),
+    ("tile_total_timesteps", "Tiling_TotalTimesteps"),
+    ("tile_timestep", "Tiling_Timestep"),
+    ("tile_timestep_size", "Tiling_Timedelta")
+)
+# per FL channel: color and (config.dat key, annotation key) pairs of the values
+FL_ANNOTATION_KEYS = [
+    (
+        color,
+        (
+            ("FLCH{}_Camera_Shutter".format(i), "FL{}_ExposureTime".format(i)),
+            ("FLCH{}_Camera_Gain".format(i), "FL{}_Gain".format(i)),
+            ("FLCH{}_Light_Intensity".format(i), "FL{}_Intensity".format(i))
+        )
+    ) for i, color in enumerate(("blue", "green", "red"))
+]
+
+
+# bounded, because the tiling annotation differs for every snapshot
+@lru_cache(maxsize=64)
+def def_map_annotation(ann_id, namespace, description, values):
+    """Create ome-types map annotation, shared by the snapshots of a setup
+
+    :param ann_id: str: ID of the annotation
+    :param namespace: str: namespace of the annotation
+    :param description: str: description of the annotation
+    :param values: tuple of (key, value) pairs of str
+    :return: ome-types map annotation
+    """
+    return model.MapAnnotation(
+        id=ann_id,
+        namespace=namespace,
+        description=description,
+        value=model.Map(ms=[{"value": value, "k": k} for k, value in values])
+    )
+
+
 def def_annotations(img_metadata, tiling_info):
     """Create ome-types StructuredAnnotations with additional per-image metadata.
 
@@ -240,17 +362,11 @@ def def_annotations(img_metadata, tiling_info):
     """
 
     anns = []
-    ann_overall = model.MapAnnotation(
-        id="Annotation:0",
-        namespace="overall",
-        description="Overall metadata for recording and setup",
-        value=model.Map(ms=[
-                {"value": img_metadata["Medium_Name"], "k": "MediumName"},
-                {"value": img_metadata["Medium_RI"], "k": "MediumRI"},
-                {"value": img_metadata["Immersion_RI"], "k": "ImmersionRI"},
-                {"value": img_metadata["Annotation"], "k": "Annotation"},
-                {"value": img_metadata["SW Version"], "k": "TomoStudioVersion"}
-        ])
+    ann_overall = def_map_annotation(
+        "Annotation:0",
+        "overall",
+        "Overall metadata for recording and setup",
+        tuple((k, img_metadata[key]) for key, k in OVERALL_ANNOTATION_KEYS)
     )
     anns.append(ann_overall)
 
@@ -259,96 +375,78 @@ def def_annotations(img_metadata, tiling_info):
     # in the metadata files
     if "Images HT3D" not in img_metadata or int(img_metadata["Images HT3D"]) > 0 \
             or int(img_metadata["Images HT2D"]) > 0:
-        ann_ht = model.MapAnnotation(
-            id="Annotation:1",
-            namespace="holotomography",
-            description="Additional metadata for HT and Phase images",
-            value=model.Map(ms=[
-                    {"value": img_metadata["mapping sign"], "k": "HT_MappingSign"},
-                    {"value": img_metadata["phase sign"], "k": "HT_PhaseSign"},
-                    {"value": img_metadata["iteration"], "k": "HT_Iterations"},
-                    {"value": img_metadata["Camera Shutter"], "k": "HT_ExposureTime"},
-                    {"value": img_metadata["Camera Gain"], "k": "HT_Gain"}
-            ])
+        ann_ht = def_map_annotation(
+            "Annotation:1",
+            "holotomography",
+            "Additional metadata for HT and Phase images",
+            tuple((k, img_metadata[key]) for key, k in HT_ANNOTATION_KEYS)
         )
         anns.append(ann_ht)
 
     if "Images BF" in img_metadata and int(img_metadata["Images BF"]) > 0:
-        ann_bf = model.MapAnnotation(
-            id="Annotation:2",
-            namespace="brightfield",
-            description="Additional metadata for brightfield image",
-            value=model.Map(ms=[
-                    {"value": img_metadata["BF_Camera_Shutter"], "k": "BF_ExposureTime"},
-                    {"value": img_metadata["BF_Light_Intensity"], "k": "BF_Intensity"}
-            ])
+        ann_bf = def_map_annotation(
+            "Annotation:2",
+            "brightfield",
+            "Additional metadata for brightfield image",
+            tuple((k, img_metadata[key]) for key, k in BF_ANNOTATION_KEYS)
         )
         anns.append(ann_bf)
 
-    ann_fl = []
-    if "Images FL" not in img_metadata or int(img_metadata["Images FL3D"]) > 0:
-        colors_dict = {0: "blue", 1: "green", 2: "red"}
-        for i in range(3):
-            if img_metadata["FLCH{}_Enable".format(i)] == "true":
-                ann_fl.append(
-                    model.MapAnnotation(
-                        id="Annotation:{}".format(i+3),
-                        namespace="fluorescence",
-                        description="Additional metadata for Fluorescence Channel {} images".format(colors_dict[i]),
-                        value=model.Map(ms=[
-                            {
-                                "value": img_metadata["FLCH{}_Camera_Shutter".format(i)],
-                                "k": "FL{}_ExposureTime".format(i)
-                            }, {
-                                "value": img_metadata["FLCH{}_Camera_Gain".format(i)],
-                                "k": "FL{}_Gain".format(i)
-                            }, {
-                                "value":  img_metadata["FLCH{}_Light_Intensity".format(i)],
-                                "k": "FL{}_Intensity".format(i)
-                            }
-                        ])
+    if "Images FL3D" not in img_metadata or int(img_metadata["Images FL3D"]) > 0:
+        for i, (color, keys) in enumerate(FL_ANNOTATION_KEYS):
+            if is_fl_channel_enabled(img_metadata, i):
+                anns.append(
+                    def_map_annotation(
+                        "Annotation:{}".format(i+3),
+                        "fluorescence",
+                        "Additional metadata for Fluorescence Channel {} images".format(color),
+                        tuple((k, img_metadata[key]) for key, k in keys)
                     )
                 )
-    anns.extend(ann_fl)
 
     if len(tiling_info) > 0:
-        ann_tiling = model.MapAnnotation(
-            id="Annotation:6",
-            namespace="tiling",
-            description="Spatial and temporal tiling information",
-            value=model.Map(ms=[
-                {"value": tiling_info["tile_img_id"], "k": "Tiling_ClusterID"},
-                {"value": tiling_info["tile_total_images"], "k": "Tiling_TotalTilesInImage"},
-                {"value": tiling_info["tile_number"], "k": "Tiling_NumberInImage"},
-                {"value": tiling_info["tile_row"], "k": "Tiling_Row"},
-                {"value": tiling_info["tile_column"], "k": "Tiling_Column"},
-                {"value": tiling_info["tile_total_timesteps"], "k": "Tiling_TotalTimesteps"},
-                {"value": tiling_info["tile_timestep"], "k": "Tiling_Timestep"},
-                {"value": tiling_info["tile_timestep_size"], "k": "Tiling_Timedelta"},
-            ])
+        ann_tiling = def_map_annotation(
+            "Annotation:6",
+            "tiling",
+            "Spatial and temporal tiling information",
+            # the tiling info holds numbers, map values are strings (pydantic 2 does not convert them)
+            tuple((k, str(tiling_info[key])) for key, k in TILING_ANNOTATION_KEYS)
         )
         anns.append(ann_tiling)
 
     return anns
 
 
+# Plane with the units of all planes. def_plane is called for every plane of every image, so it copies this template
+# with the per-plane values instead of validating a new model each time
+PLANE_TEMPLATE = model.Plane(the_c=0, the_t=0, the_z=0, position_x_unit="mm", position_y_unit="mm")
+
+
 def def_plane(x_coord, y_coord, z_coord, delta_t, thec, thet, thez):
-    plane = model.Plane(
-        the_c=thec,
-        the_t=thet,
-        the_z=thez,
-        position_x=x_coord,
-        position_y=y_coord,
-        position_z=z_coord,
-        position_x_unit="mm",
-        position_y_unit="mm",
-        delta_t=delta_t
-    )
-    return plane
+    # the copy is not validated, so convert to the field types here (the tiling info holds the timestep as float)
+    return PLANE_TEMPLATE.model_copy(update=dict(
+        the_c=int(thec),
+        the_t=int(thet),
+        the_z=int(thez),
+        position_x=float(x_coord),
+        position_y=float(y_coord),
+        position_z=float(z_coord),
+        delta_t=float(delta_t)
+    ))
+
+
+# Pixels and Image models with the fields that are the same for all images of one data type. build_ome_xml copies
+# them instead of validating a new model for every image
+PIXELS_TEMPLATES = {
+    data_type: model.Pixels(
+        dimension_order="XYZTC", size_c=1, size_t=1, size_x=1, size_y=1, size_z=1, type=data_type
+    ) for data_type in ("uint8", "uint16", "float")
+}
+IMAGE_TEMPLATE = model.Image(pixels=PIXELS_TEMPLATES["uint16"])
 
 
 def build_ome_xml(
-    data_use,
+    attrs,
     offset,
     channels,
     timestamp,
@@ -359,11 +457,13 @@ def build_ome_xml(
     stagelabel,
     data_type,
     ann_ids,
-    planes
+    planes,
+    image_index
 ):
-    """Create OME-XML file from given ome-types metadata
+    """Create OME-XML file from given ome-types metadata. The Pixels and Image models are copied from the
+    validated templates for the data type with the per-image values updated, which skips the field validation.
 
-    :param data_use: raw tcf/h5 input data with metadata
+    :param attrs: Dict with the attributes of the tcf/h5 group of the image (e.g. dict(group.attrs))
     :param offset: int: plane offset
     :param channels: ome-types list of channels used in image
     :param timestamp: str: timestamp in YYYY-MM-DD format the image was acquired at
@@ -375,54 +475,72 @@ def build_ome_xml(
     :param data_type: Python data type of the image data
     :param ann_ids: IDs of annotations with additional image metadata
     :param planes: ome-types list of planes
+    :param image_index: int: index of the image in the OME-XML, used for the Image and Pixels IDs
     :return: ome-types image with relevant metadata
     :return: int to give the image plane offset for the next image in a multidimensional array
     (with t and channel components)
     """
-    try:
-        len_z = data_use.attrs["SizeZ"][0]
-        physical_size_z = round(data_use.attrs["ResolutionZ"][0], 2)
-    except KeyError:
+    if "SizeZ" in attrs:
+        len_z = attrs["SizeZ"][0]
+        resolutions = (attrs["ResolutionX"][0], attrs["ResolutionY"][0], attrs["ResolutionZ"][0])
+    else:  # 2D modalities
         len_z = 1
-        physical_size_z = None
-    len_t = data_use.attrs["DataCount"][0]
+        resolutions = (attrs["ResolutionX"][0], attrs["ResolutionY"][0])
+    # round all axes in one call, tolist() returns plain Python floats
+    physical_sizes = np.round(resolutions, 2).tolist()
+    physical_size_z = physical_sizes[2] if len(physical_sizes) == 3 else None
+    len_t = attrs["DataCount"][0]
     len_c = 1
     n_planes = len_z * len_t * len_c
 
     tiffdata = [model.TiffData(plane_count=n_planes, ifd=offset)]
 
-    pixels = model.Pixels(
-        dimension_order="XYZTC",
-        size_c=len_c,
-        size_t=len_t,
-        size_x=data_use.attrs["SizeX"][0],
-        size_y=data_use.attrs["SizeY"][0],
-        size_z=len_z,
-        type=data_type,
-        physical_size_x=round(data_use.attrs["ResolutionX"][0], 2),
-        physical_size_y=round(data_use.attrs["ResolutionY"][0], 2),
-        physical_size_z=physical_size_z,
-        tiff_data_blocks=tiffdata,
-        time_increment=data_use.attrs["TimeInterval"][0],
-        channels=channels,
-        planes=planes
-    )
-
-    image = model.Image(
-        pixels=pixels,
-        acquisition_date=timestamp,
-        name=description,
-        description=description,
-        experiment_ref=model.ExperimentRef(id=experiment.id),
-        experimenter_ref=model.ExperimenterRef(id=experimenter.id),
-        instrument_ref=model.InstrumentRef(id=instrument.id),
-        annotation_refs=[model.AnnotationRef(id=i) for i in ann_ids],
-        stage_label=stagelabel
-    )
+    # the templates were validated once at import, values that are not validated here are converted to plain Python
+    # types explicitly
+    pixels = PIXELS_TEMPLATES[data_type].model_copy(update={
+        "id": "Pixels:{}".format(image_index),
+        "size_c": len_c,
+        "size_t": int(len_t),
+        "size_x": int(attrs["SizeX"][0]),
+        "size_y": int(attrs["SizeY"][0]),
+        "size_z": int(len_z),
+        "physical_size_x": physical_sizes[0],
+        "physical_size_y": physical_sizes[1],
+        "physical_size_z": physical_size_z,
+        "tiff_data_blocks": tiffdata,
+        "time_increment": float(attrs["TimeInterval"][0]),
+        "channels": channels,
+        "planes": planes
+    })
+
+    image = IMAGE_TEMPLATE.model_copy(update={
+        "id": "Image:{}".format(image_index),
+        "pixels": pixels,
+        "acquisition_date": timestamp,
+        "name": description,
+        "description": description,
+        "experiment_ref": model.ExperimentRef(id=experiment.id),
+        "experimenter_ref": model.ExperimenterRef(id=experimenter.id),
+        "instrument_ref": model.InstrumentRef(id=instrument.id),
+        "annotation_refs": [model.AnnotationRef(id=i) for i in ann_ids],
+        "stage_label": stagelabel
+    })
 
     return image, offset + n_planes
 
 
+def parse_key_value_lines(lines, delimiter=","):
+    """Parse lines of the form "key<delimiter>value" into a dict using the C-implemented csv tokenizer. Only the
+    first delimiter separates key and value, empty lines and lines without delimiter are skipped.
+
+    :param lines: Iterable of lines, e.g. a file opened with newline=""
+    :param delimiter: str: character separating key and value
+    :return: Dict mapping keys to values (str)
+    """
+    reader = csv.reader(lines, delimiter=delimiter, quoting=csv.QUOTE_NONE)
+    return {row[0]: delimiter.join(row[1:]) for row in reader if len(row) >= 2}
+
+
 def read_basic_user_config(filepath):
     """Read user-created file with metadata needed to create the OME-TIFF.
 
@@ -431,16 +549,16 @@ def read_basic_user_config(filepath):
     """
 
     logging.debug("Reading basic OME config from {}".format(filepath))
-    with open(filepath) as f:
-        config_dat = f.readlines()
-    config_dat = [item.split(",", 1) for item in config_dat if item not in ("\n", "\r\n")]
-    config_dict = {item[0]: item[1].strip("\r\n").strip("\n") for item in config_dat}
+    with open(filepath, newline="") as f:
+        config_dict = parse_key_value_lines(f)
     return config_dict
 
 
 def def_ome_basic_md(config_dict):
     """Create experimenter and project metadata dictionaries needed to
-create the OME-TIFF from user-provided metadata.
+create the OME-TIFF from user-provided metadata. The detector, light sources and
+HT / BF channels only depend on this metadata as well, so they are created here
+once and shared by all images instead of once per image.
 
     :param config_dict: Dict of user-created metadata
     :return: Dict containing metadata needed for OME-TIFF
@@ -459,6 +577,15 @@ create the OME-TIFF from user-provided metadata.
     basic_ome_md["proj"] = def_project(
         config_dict["proj_id"], config_dict["proj_name"], config_dict["proj_desc"]
     )
+    basic_ome_md["det"] = [def_det(config_dict["det_id"])]
+    basic_ome_md["lasers"] = [def_light_source(config_dict["light_source_id_ht"])]
+    basic_ome_md["leds"] = [
+        def_light_source(config_dict["light_source_id_fl0"]),
+        def_light_source(config_dict["light_source_id_fl1"]),
+        def_light_source(config_dict["light_source_id_fl2"])
+    ]
+    basic_ome_md["channel_ht"] = def_channel("ht")
+    basic_ome_md["channel_bf"] = def_channel("bf")
     return basic_ome_md
 
 
@@ -486,27 +613,20 @@ def read_image_config(folder):
     """
 
     # read and treat config.dat
-    with open(join(folder, "config.dat")) as f:
-        exp_config_dat_1 = f.readlines()
-
-    for i in range(len(exp_config_dat_1)):  # output lacks a ","
-        if exp_config_dat_1[i].startswith("Immersion_RI"):
-            exp_config_dat_1[i] = "Immersion_RI," + exp_config_dat_1[i][12:]
-            break
-
-    exp_config_dat_1 = [item.rstrip("\n").split(",", 1) for item in exp_config_dat_1 if item != "\n"]
+    with open(join(folder, "config.dat"), newline="") as f:
+        exp_config_dict = parse_key_value_lines(
+            # output lacks a ","
+            "Immersion_RI," + line[12:] if line.startswith("Immersion_RI") else line for line in f
+        )
 
     # read and treat JobParameter.tcp
-    with open(join(folder, "JobParameter.tcp")) as f:
-        exp_config_dat_2 = f.readlines()[1:]
-
-    exp_config_dat_2 = [item.rstrip("\n").split("=", 1) for item in exp_config_dat_2 if item != "\n"]
+    with open(join(folder, "JobParameter.tcp"), newline="") as f:
+        next(f)  # skip section header
+        exp_config_dict.update(parse_key_value_lines(f, delimiter="="))
 
-    # read and treat position.txt
+    # read and treat position.txt, float() ignores the surrounding whitespace and line breaks
     with open(join(folder, "position.txt")) as f:
-        exp_config_dat_3 = f.readlines()
-
-    exp_config_dat_3 = [float(item.rstrip("\n")) for item in exp_config_dat_3 if item != "\n"]
+        exp_config_dat_3 = [float(line) for line in f if not line.isspace()]
     exp_config_dict_3 = {
         "x_rec": exp_config_dat_3[0],
         "y_rec": exp_config_dat_3[1],
@@ -514,36 +634,35 @@ def read_image_config(folder):
         "c_rec": exp_config_dat_3[3]
     }
 
-    # print(*exp_config_dat_1, sep="\n")
-    # print(*exp_config_dat_2, sep="\n")
     # merge
-    exp_config_dict = {item[0]: item[1] for item in exp_config_dat_1}
-    exp_config_dict.update({item[0]: item[1] for item in exp_config_dat_2})
     exp_config_dict.update(exp_config_dict_3)
 
     return exp_config_dict
 
 
+def convert_tiling_value(item):
+    """Convert a value of tiling_info.txt to a number if possible.
+
+    :param item: str: value as read from the file
+    :return: float if the value contains a ".", else int, or the stripped str if it is not a number
+    """
+    try:
+        if "." in item:
+            return float(item)
+        return int(item)
+    except ValueError:
+        return item.strip()
+
+
 def read_tiling_info(folder):
     """Read tiling info for image.
 
     :param folder: Folder name as string
     :return: Dict containing the per-image tiling data
     """
-    def convert_to_float(item):
-        try:
-            if "." in item:
-                return float(item)
-            return int(item)
-        except ValueError:
-            return item.strip()
-
     try:
-        with open(join(folder, "tiling_info.txt")) as f:
-            tiling_info = f.readlines()
-
-        tmp = [item.split(",") for item in tiling_info]
-        tiling_dict = {item[0]: convert_to_float(item[1]) for item in tmp}
+        with open(join(folder, "tiling_info.txt"), newline="") as f:
+            tiling_dict = {key: convert_tiling_value(value) for key, value in parse_key_value_lines(f).items()}
     except FileNotFoundError:
         logging.debug("Tiling info not found.")
         tiling_dict = {}
@@ -551,6 +670,16 @@ def read_tiling_info(folder):
     return tiling_dict
 
 
+def is_fl_channel_enabled(img_config_dict, channel):
+    """Check whether an FL channel is enabled in JobParameter.tcp. Channels without the setting count as enabled.
+
+    :param img_config_dict: Dict with per-image metadata extracted from config file in image folder
+    :param channel: int or str: number of the FL channel
+    :return: False if the channel is disabled
+    """
+    return img_config_dict.get("FLCH{}_Enable".format(channel)) != "false"
+
+
 def define_image_metadata(overall_config_dict, img_config_dict, tiling_dict):
     """Integrate project and image metadata to obtain comprehensive metadata dict
 used to create the OME-TIFF.
@@ -568,18 +697,15 @@ used to create the OME-TIFF.
     img_metadata["mic"] = def_mic(
         img_config_dict["Serial"], overall_config_dict["mic_model"], overall_config_dict["mic_lot"]
     )
-    img_metadata["det"] = [def_det(overall_config_dict["det_id"])]
+    # shared by all images of a run, see def_ome_basic_md
+    img_metadata["det"] = overall_config_dict["det"]
     img_metadata["obj"] = def_obj(
         overall_config_dict["obj_id"],
         img_config_dict["NA"],
         img_config_dict["M"]
     )
-    img_metadata["lasers"] = [def_light_source(overall_config_dict["light_source_id_ht"])]
-    img_metadata["leds"] = [
-        def_light_source(overall_config_dict["light_source_id_fl0"]),
-        def_light_source(overall_config_dict["light_source_id_fl1"]),
-        def_light_source(overall_config_dict["light_source_id_fl2"])
-    ]
+    img_metadata["lasers"] = overall_config_dict["lasers"]
+    img_metadata["leds"] = overall_config_dict["leds"]
     img_metadata["instr"] = def_instr(
         overall_config_dict["instr_id"],
         img_metadata["mic"],
@@ -587,18 +713,554 @@ used to create the OME-TIFF.
         img_metadata["lasers"],
         img_metadata["leds"]
     )
-    img_metadata["channel_ht"] = def_channel("ht")
-    img_metadata["channel_bf"] = def_channel("bf")
-    img_metadata["channel_fl0"] = def_channel("fl0", img_config_dict)
-    img_metadata["channel_fl1"] = def_channel("fl1", img_config_dict)
-    img_metadata["channel_fl2"] = def_channel("fl2", img_config_dict)
+    img_metadata["channel_ht"] = overall_config_dict["channel_ht"]
+    img_metadata["channel_bf"] = overall_config_dict["channel_bf"]
+    # disabled FL channels are skipped by transform_tcf, so their channel is not needed
+    for i in range(3):
+        img_metadata["channel_fl{}".format(i)] = def_channel("fl{}".format(i), img_config_dict) \
+            if is_fl_channel_enabled(img_config_dict, i) else None
 
     img_metadata["anns"] = def_annotations(img_config_dict, tiling_dict)
 
     return img_metadata
 
 
-def transform_tcf(folder, overall_md, output_xml=False):
+def get_chunk_cache_bytes(file_path):
+    """Determine the size of the raw data chunk cache for reading a TCF file. HDF5 applies the size to every open
+    dataset separately, so it is chosen for reading one timestep: TCF_CHUNK_CACHE_CHUNKS chunks, but not more than the
+    timestep itself. The shapes are probed on the first dataset of every imaging modality, assuming that all timesteps
+    of one modality are chunked alike.
+
+    :param file_path: Path of the TCF file
+    :return: int: cache size per open dataset in bytes, between TCF_CHUNK_CACHE_MIN_BYTES and TCF_CHUNK_CACHE_MAX_BYTES
+    """
+    cache_bytes = 0
+    with h5py.File(file_path, "r", libver="latest", swmr=True) as dat:
+        for item in dat["Data"].values():
+            # descend to the first timestep, FL modalities have one more group level for the channels
+            while isinstance(item, h5py.Group) and len(item) > 0:
+                item = next(iter(item.values()))
+            if isinstance(item, h5py.Dataset) and item.chunks is not None:
+                chunk_bytes = int(np.prod(item.chunks)) * item.dtype.itemsize
+                timestep_bytes = int(np.prod(item.shape)) * item.dtype.itemsize
+                cache_bytes = max(cache_bytes, min(TCF_CHUNK_CACHE_CHUNKS * chunk_bytes, timestep_bytes))
+    return min(TCF_CHUNK_CACHE_MAX_BYTES, max(TCF_CHUNK_CACHE_MIN_BYTES, cache_bytes))
+
+
+def open_tcf(file_path):
+    """Open a TCF file read-only with HDF5 settings tuned for reading whole image stacks.
+
+    :param file_path: Path of the TCF file
+    :return: h5py.File, to be used as context manager
+    """
+    settings = dict(
+        libver="latest",
+        rdcc_nbytes=get_chunk_cache_bytes(file_path),
+        rdcc_nslots=TCF_CHUNK_CACHE_SLOTS,
+        rdcc_w0=TCF_CHUNK_CACHE_W0,
+        page_buf_size=TCF_PAGE_BUFFER_BYTES,
+        min_meta_keep=TCF_PAGE_BUFFER_MIN_META_PERC,
+        min_raw_keep=0
+    )
+    if getsize(file_path) <= TCF_CORE_DRIVER_MAX_BYTES:
+        try:
+            return h5py.File(file_path, "r", driver="core", backing_store=False, **settings)
+        except OSError:
+            # the core driver does not support SWMR, so a file still held open for writing is opened below
+            logging.debug("Cannot read {} into memory, it is opened for writing".format(file_path))
+    # SWMR read mode allows converting a TCF that TomoStudio still holds open for writing
+    return h5py.File(file_path, "r", swmr=True, **settings)
+
+
+def build_tcf_cache(tcf_path, cache_path):
+    """Re-export a TCF file into an HDF5 file with the same groups, datasets and attributes, but with every timestep
+    dataset stored as a single LZF compressed chunk. Whole timesteps, which is how transform_tcf reads the data, are
+    then read with one chunk lookup and decompression each, independent of the chunking TomoStudio used.
+
+    :param tcf_path: Path of the TCF file
+    :param cache_path: Path of the cache file to create
+    """
+    tmp_path = cache_path + ".part"
+    # the paged file space strategy lets open_tcf serve the metadata reads of the cache from its page buffer
+    with open_tcf(tcf_path) as src, h5py.File(tmp_path, "w", libver="latest", fs_strategy="page") as dst:
+        # all timesteps of one modality have the same shape and type, so they are copied through one buffer each
+        buffers = {}
+
+        def copy_item(name, item):
+            if isinstance(item, h5py.Group):
+                dst_item = dst.create_group(name)
+            elif item.ndim == 0:
+                dst_item = dst.create_dataset(name, data=item[()])
+            else:
+                dst_item = dst.create_dataset(
+                    name, shape=item.shape, dtype=item.dtype, chunks=item.shape, compression="lzf"
+                )
+                buffer_key = (item.shape, item.dtype)
+                if buffer_key not in buffers:
+                    buffers[buffer_key] = np.empty(item.shape, dtype=item.dtype)
+                item.read_direct(buffers[buffer_key])
+                dst_item.write_direct(buffers[buffer_key])
+            for key, value in item.attrs.items():
+                dst_item.attrs.create(key, value, dtype=item.attrs.get_id(key).dtype)
+
+        for key, value in src.attrs.items():
+            dst.attrs.create(key, value, dtype=src.attrs.get_id(key).dtype)
+        src.visititems(copy_item)
+    replace(tmp_path, cache_path)
+
+
+def get_tcf_cache(tcf_path):
+    """Get the path of the re-exported cache of a TCF file (see build_tcf_cache) and create the cache if it does not
+    exist or is older than the TCF file.
+
+    :param tcf_path: Path of the TCF file
+    :return: str: path of the cache file (the TCF path with the additional extension .fast.h5)
+    """
+    cache_path = tcf_path + ".fast.h5"
+    try:
+        if getmtime(cache_path) >= getmtime(tcf_path):
+            return cache_path
+    except OSError:
+        pass
+    logging.info("Creating cache {}".format(cache_path))
+    build_tcf_cache(tcf_path, cache_path)
+    return cache_path
+
+
+def take_scratch(scratch, n_bytes):
+    """Get a buffer of at least n_bytes from scratch memory that is shared by images read one after another. The
+    buffer is only replaced by a larger one when an image needs more memory than all images before it.
+
+    :param scratch: Dict holding the current buffer, empty before the first image
+    :param n_bytes: int: number of bytes needed
+    :return: uint8 numpy array with at least n_bytes elements
+    """
+    if "buffer" not in scratch or scratch["buffer"].nbytes < n_bytes:
+        scratch["buffer"] = np.empty(n_bytes, dtype=np.uint8)
+    return scratch["buffer"]
+
+
+def iter_image_stack(group, plane=None, n_buffers=1, dtype=None, scratch=None):
+    """Read the timesteps of one imaging modality one after another into reused buffers, so that only n_buffers
+    timesteps have to be held in memory at a time.
+
+    :param group: h5py group that holds one dataset per timestep
+    :param plane: Optional index along the first axis of the datasets. If given, only this plane of every timestep is
+    read (e.g. the first color plane of brightfield images)
+    :param n_buffers: Number of buffers that are used in turn, see prefetch_blocks
+    :param dtype: Optional numpy dtype of the yielded arrays. HDF5 converts the data while reading, which avoids a
+    separate conversion copy (default: dtype of the datasets)
+    :param scratch: Optional scratch memory dict (see take_scratch) the buffers are taken from. Only one generator
+    may use the same scratch memory at a time
+    :return: generator of numpy arrays with the shape of one timestep dataset (without the first axis if plane is
+    given). The buffers are reused, a yielded array is overwritten when the generator is advanced n_buffers times
+    """
+    # read with the low-level dataset ids directly, which skips the selection handling of the high-level Dataset API.
+    # Every timestep is opened only while it is read: HDF5 keeps a chunk cache per open dataset, so holding all of
+    # them open would make the memory use grow with the number of timesteps
+    names = [name.encode("utf-8") for name in group]
+    first_id = h5py.h5d.open(group.id, names[0])
+    shape = first_id.shape
+    buffer_shape = shape if plane is None else shape[1:]
+    buffer_dtype = first_id.dtype if dtype is None else np.dtype(dtype)
+    n_buffers = min(n_buffers, len(names))
+    del first_id
+    if scratch is None:
+        buffers = [np.empty(buffer_shape, dtype=buffer_dtype) for _ in range(n_buffers)]
+    else:
+        buffer_bytes = int(np.prod(buffer_shape)) * buffer_dtype.itemsize
+        memory = take_scratch(scratch, n_buffers * buffer_bytes)
+        buffers = [
+            memory[k * buffer_bytes:(k + 1) * buffer_bytes].view(buffer_dtype).reshape(buffer_shape)
+            for k in range(n_buffers)
+        ]
+    mem_space = h5py.h5s.ALL if plane is None else h5py.h5s.create_simple(buffer_shape)
+    for i, name in enumerate(names):
+        dataset_id = h5py.h5d.open(group.id, name)
+        if dataset_id.shape != shape:
+            raise ValueError(
+                "Inconsistent timestep shapes in {}: {} and {}".format(group.name, shape, dataset_id.shape)
+            )
+        if plane is None:
+            file_space = h5py.h5s.ALL
+        else:
+            file_space = dataset_id.get_space()
+            file_space.select_hyperslab((plane,) + (0,) * (len(shape) - 1), (1,) + shape[1:])
+        buffer = buffers[i % len(buffers)]
+        dataset_id.read(mem_space, file_space, buffer)
+        del dataset_id, file_space
+        yield buffer
+
+
+def prefetch_blocks(blocks, n_blocks=PREFETCH_BLOCKS):
+    """Read the blocks of an image in a background thread, so that reading and decompressing the next block from the
+    TCF overlaps with compressing and writing the current one. HDF5 reads and the TIFF compression both release the
+    GIL. At most n_blocks blocks are read ahead and not yet consumed, counting the block the consumer is using.
+    Iterables that reuse buffers (see iter_image_stack) therefore need at least n_blocks buffers.
+
+    :param blocks: iterable of numpy arrays
+    :param n_blocks: Maximum number of blocks in flight
+    :return: generator of the blocks in the given order
+    """
+    filled = queue.Queue()
+    free = threading.Semaphore(n_blocks)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            blocks_iter = iter(blocks)
+            while True:
+                # wait until the consumer has released a block before the next read may overwrite a buffer
+                free.acquire()
+                if stop.is_set():
+                    return
+                block = next(blocks_iter, None)
+                filled.put((block, None))
+                if block is None:
+                    return
+        except Exception as e:
+            filled.put((None, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            block, error = filled.get()
+            if error is not None:
+                raise error
+            if block is None:
+                return
+            yield block
+            free.release()
+    finally:
+        # also stops the producer if the consumer ends early, e.g. because writing failed
+        stop.set()
+        free.release()
+        producer.join()
+
+
+def rescale_to_uint16_numpy(img, lo, hi, out, scratch=None):
+    """Numpy implementation of rescale_to_uint16, used if numba is not installed."""
+    if scratch is None:
+        scratch = np.empty_like(img)
+    # work in place on one float buffer instead of allocating a temporary image for every operation
+    np.subtract(img, lo, out=scratch)
+    np.multiply(scratch, 65535 / (hi - lo), out=scratch)
+    # casting NaN to uint16 is undefined, so NaN becomes 0 like in the numba kernel
+    np.nan_to_num(scratch, copy=False, nan=0.0)
+    np.clip(scratch, 0, 65535, out=scratch)
+    out[...] = scratch
+
+
+@lru_cache(maxsize=None)
+def get_rescale_kernel():
+    """Compile the parallel Numba kernel of rescale_to_uint16 on first use. numba is optional and takes longer to
+    import than all other dependencies, so it is only imported if phasemaps are rescaled.
+
+    :return: kernel function working on flat arrays or None if numba is not installed
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(parallel=True, cache=True)
+    def rescale_to_uint16_numba(img, lo, hi, out):
+        scale = 65535 / (hi - lo)
+        for i in prange(img.size):
+            value = (img[i] - lo) * scale
+            if np.isnan(value):
+                value = 0.0
+            out[i] = np.uint16(min(max(value, 0.0), 65535.0))
+
+    # the first call compiles the kernel for float32 phasemaps (or loads it from numba's cache) and starts numba's
+    # threading layer. The TBB layer hangs at interpreter exit if it was started in another thread than the main
+    # thread, so transform_folder calls this function before it starts worker threads
+    rescale_to_uint16_numba(np.zeros(1, dtype=np.float32), 0.0, 1.0, np.zeros(1, dtype=np.uint16))
+    return rescale_to_uint16_numba
+
+
+def rescale_to_uint16(img, lo, hi, out, scratch=None):
+    """Rescale a float image linearly from [lo, hi] to the full uint16 range, values outside are clipped and NaN
+    becomes 0. Uses a compiled parallel kernel if numba is installed.
+
+    :param img: C-contiguous float numpy array
+    :param lo: float: value mapped to 0
+    :param hi: float: value mapped to 65535
+    :param out: C-contiguous uint16 numpy array with the shape of img that the result is written to
+    :param scratch: Optional float numpy array with the shape and dtype of img, used as intermediate buffer by the
+    numpy implementation (allocated if not given)
+    """
+    kernel = get_rescale_kernel()
+    if kernel is not None:
+        kernel(img.ravel(), float(lo), float(hi), out.ravel())
+    else:
+        rescale_to_uint16_numpy(img, lo, hi, out, scratch)
+
+
+def iter_rescaled_to_uint16(blocks, value_range):
+    """Rescale the blocks of an image to uint16 one after another, see rescale_to_uint16.
+
+    :param blocks: iterable of float numpy arrays (e.g. from iter_image_stack)
+    :param value_range: tuple (lo, hi) of the values mapped to 0 and 65535
+    :return: generator of uint16 numpy arrays. The same buffer is reused for blocks of the same shape
+    """
+    out = scratch = None
+    for block in blocks:
+        if out is None or out.shape != block.shape:
+            out = np.empty(block.shape, dtype=np.uint16)
+            scratch = np.empty(block.shape, dtype=block.dtype) if get_rescale_kernel() is None else None
+        rescale_to_uint16(np.ascontiguousarray(block), value_range[0], value_range[1], out, scratch)
+        yield out
+
+
+def read_timesteps(timesteps, scratch, plane=None, dtype=None):
+    """Stream the timesteps of an image with the next timestep read in the background, see iter_image_stack and
+    prefetch_blocks.
+
+    :param timesteps: h5py group that holds one dataset per timestep
+    :param scratch: Scratch memory dict for the buffers, see take_scratch
+    :param plane: Optional index along the first axis of the datasets, see iter_image_stack
+    :param dtype: Optional numpy dtype the data is converted to while reading, see iter_image_stack
+    :return: generator of numpy arrays, one per timestep
+    """
+    return prefetch_blocks(
+        iter_image_stack(timesteps, plane=plane, n_buffers=PREFETCH_BLOCKS, dtype=dtype, scratch=scratch)
+    )
+
+
+def read_2dmip(timesteps, channel, img_md, phase_range, scratch):
+    """Image reader for 2D HT maximum intensity projections, see MODALITY_READERS."""
+    return img_md["channel_ht"], "2D Holotomography Maximum Intensity Projection", "uint16", \
+        read_timesteps(timesteps, scratch), 1
+
+
+def read_2d(timesteps, channel, img_md, phase_range, scratch):
+    """Image reader for 2D phasemaps, see MODALITY_READERS. With a phase_range, the phasemaps are rescaled to
+    uint16."""
+    if phase_range is None:
+        return img_md["channel_ht"], "2D Phasemap", "float", read_timesteps(timesteps, scratch), 1
+    # rescaled in the writing thread, the numba TBB threading layer can hang at exit if the kernel was run in a helper
+    # thread
+    return img_md["channel_ht"], "2D Phasemap", "uint16", \
+        iter_rescaled_to_uint16(read_timesteps(timesteps, scratch), phase_range), 1
+
+
+def read_bf(timesteps, channel, img_md, phase_range, scratch):
+    """Image reader for 2D brightfield images, see MODALITY_READERS. Only the first color plane is stored, as uint8
+    like declared in the OME-XML."""
+    return img_md["channel_bf"], "2D Brightfield", "uint8", \
+        read_timesteps(timesteps, scratch, plane=0, dtype=np.uint8), 2
+
+
+def read_3d(timesteps, channel, img_md, phase_range, scratch):
+    """Image reader for 3D HT images, see MODALITY_READERS."""
+    return img_md["channel_ht"], "3D Holotomography", "uint16", read_timesteps(timesteps, scratch), 1
+
+
+def read_2dflmip(timesteps, channel, img_md, phase_range, scratch):
+    """Image reader for 2D FL maximum intensity projections of one channel, see MODALITY_READERS."""
+    channel_md = img_md["channel_fl{}".format(channel[2])]
+    return channel_md, "2D {} Maximum Intensity Projection".format(channel_md.name), "uint16", \
+        read_timesteps(timesteps, scratch), 3 + int(channel[2])
+
+
+def read_3dfl(timesteps, channel, img_md, phase_range, scratch):
+    """Image reader for 3D FL images of one channel, see MODALITY_READERS."""
+    channel_md = img_md["channel_fl{}".format(channel[2])]
+    return channel_md, "3D {}".format(channel_md.name), "uint16", read_timesteps(timesteps, scratch), \
+        3 + int(channel[2])
+
+
+# image readers of the imaging modalities in a TCF file. They are called with the group of timesteps, the FL channel
+# name (e.g. "CH0", None for other modalities), the image metadata dict, the phase_range of transform_tcf and the
+# scratch memory dict of the TCF file (see take_scratch) and return the ome-types channel, description and data type
+# of the image, the generator of its timesteps and the index of its annotation
+MODALITY_READERS = {
+    "2DMIP": read_2dmip,
+    "2D": read_2d,
+    "BF": read_bf,
+    "3D": read_3d,
+    "2DFLMIP": read_2dflmip,
+    "3DFL": read_3dfl
+}
+
+
+@lru_cache(maxsize=None)
+def get_xml_serializer():
+    """Create the xsdata serializer that ome-types renders OME-XML with. to_xml creates a new one on every call, which
+    has to inspect all model classes again; the first serializer keeps this metadata for all later images.
+
+    :return: serializer configured like the defaults of ome_types.to_xml or None if the xsdata bindings of ome-types
+    0.4 are not available (then to_xml is used)
+    """
+    # both are internals of ome-types 0.4, other versions render OME-XML differently
+    if not hasattr(model.OME, "_update_set_fields"):
+        return None
+    try:
+        from xsdata_pydantic_basemodel.bindings import SerializerConfig, XmlSerializer
+    except ImportError:
+        return None
+    config = SerializerConfig(
+        pretty_print=True,
+        pretty_print_indent="  ",
+        xml_declaration=False,
+        ignore_default_attributes=False,
+        ignore_unset_attributes=True
+    )
+    config.schema_location = "{0} {0}/ome.xsd".format(OME_NAMESPACE)
+    return XmlSerializer(config=config)
+
+
+def serialize_ome(ome):
+    """Serialize an ome-types OME object to OME-XML, with the same output as ome_types.to_xml(ome).
+
+    :param ome: ome_types.model.OME
+    :return: str: OME-XML
+    """
+    serializer = get_xml_serializer()
+    if serializer is None:
+        return to_xml(ome, canonicalize=False)
+    # to_xml does this as well: fields only appear in the XML if they are marked as set, which needs to be updated
+    # for fields changed without pydantic noticing (e.g. lists)
+    ome._update_set_fields()
+    return serializer.render(ome, ns_map={None: OME_NAMESPACE})
+
+
+@lru_cache(maxsize=None)
+def get_tiff_compression(compression, level, dtype):
+    """Find the arguments of tifffile's TiffWriter.write for a compression. The candidates are written to a small page
+    with exactly these arguments, because codecs other than zlib (e.g. zstd) and the predictor of float data need the
+    imagecodecs package, some codecs do not take a level (e.g. lzw) and some cannot use a predictor (e.g. jpeg).
+
+    :param compression: str: tifffile compression name (e.g. "zlib", "zstd") or "none"
+    :param level: int: compression level or None for the default level of the codec
+    :param dtype: str: numpy data type of the pages (e.g. "uint16")
+    :return: tuple of (keyword, value) pairs, which can be shared from the cache unlike a dict, or None if tifffile
+    cannot write with the compression or it is not in TIFF_LOSSLESS_COMPRESSIONS
+    """
+    if compression == "none":
+        return (("compression", None),)
+    if compression.lower() not in TIFF_LOSSLESS_COMPRESSIONS:
+        logging.warning("Compression {} is not one of the lossless compressions {}".format(
+            compression, ", ".join(TIFF_LOSSLESS_COMPRESSIONS)
+        ))
+        return None
+    candidates = []
+    # horizontal differencing for integer, floating point predictor for float data
+    for predictor in (True, False):
+        if level is not None:
+            candidates.append(dict(compression=compression, compressionargs={"level": level}, predictor=predictor))
+        candidates.append(dict(compression=compression, predictor=predictor))
+    # values across the whole uint16 range, some codecs only fail for larger values (e.g. 8 bit jpeg)
+    page = (np.arange(256, dtype=np.uint32) * 257).reshape(16, 16).astype(dtype)
+    errors = []
+    for args in candidates:
+        try:
+            tifffile.imwrite(io.BytesIO(), page, **args)
+        except Exception as e:  # e.g. KeyError for a missing codec, zlib.error for an invalid level
+            errors.append(e)
+            continue
+        if len(errors) > 0:
+            if "compressionargs" in args or level is None:
+                change = "without predictor"
+            elif args["predictor"]:
+                change = "with its default level"
+            else:
+                change = "with its default level and without predictor"
+            logging.warning("Compression {} level {} is not available for {} pages ({}), using it {}".format(
+                compression, level, dtype, errors[0], change
+            ))
+        return tuple(args.items())
+    logging.warning("Compression {} is not available for {} pages ({})".format(compression, dtype, errors[-1]))
+    return None
+
+
+@lru_cache(maxsize=None)
+def get_tiff_compression_args(compression, level, dtype, fallback=None):
+    """Get the compression arguments of tifffile's TiffWriter.write for a compression.
+
+    :param compression: str: tifffile compression name or "none", see get_tiff_compression
+    :param level: int: compression level or None for the default level of the codec
+    :param dtype: str: numpy data type of the pages
+    :param fallback: Optional tuple (compression, level) used if the compression is not available
+    :return: tuple of (keyword, value) pairs, see get_tiff_compression. Those of fallback or else of TIFF_COMPRESSION
+    and TIFF_COMPRESSION_LEVEL if the compression is not available
+    """
+    args = get_tiff_compression(compression, level, dtype)
+    if args is None and fallback is not None and fallback != (compression, level):
+        logging.warning("Using compression {} level {} instead of {}".format(fallback[0], fallback[1], compression))
+        return get_tiff_compression_args(fallback[0], fallback[1], dtype)
+    if args is None:
+        logging.warning("Using compression {} level {} instead of {}".format(
+            TIFF_COMPRESSION, TIFF_COMPRESSION_LEVEL, compression
+        ))
+        args = get_tiff_compression(TIFF_COMPRESSION, TIFF_COMPRESSION_LEVEL, dtype)
+    return args
+
+
+def write_ome_tiff(
+    file_name, imgs, xml_out, compression=TIFF_COMPRESSION, compression_level=TIFF_COMPRESSION_LEVEL, maxworkers=None,
+    compressions=None
+):
+    """Write images to an OME-TIFF file with tifffile. The images are streamed to the file block by block (typically
+    one timestep per block), the pages of all blocks are stored in the order given. The OME-XML is stored as
+    description of the first page. Planes of at least TIFF_TILE_SIZE pixels in both directions are stored as tiles.
+    The file only appears under its final name once it is complete.
+
+    :param file_name: Path of the OME-TIFF file
+    :param imgs: list of iterables of numpy arrays, one iterable per image in the OME-XML
+    :param xml_out: str: serialized OME-XML describing all images
+    :param compression: str: tifffile compression of the pages (e.g. "zlib", "zstd") or "none", see
+    get_tiff_compression
+    :param compression_level: int: compression level
+    :param maxworkers: int: maximum number of threads compressing the tiles of a page. None lets tifffile choose (up
+    to half of the CPUs for large pages), use 1 when other processes already compress in parallel
+    :param compressions: Optional list with one tuple (compression, level) per image in imgs that replaces compression
+    and compression_level for this image (None entries keep them). TIFF stores the compression per page, so the images
+    can be compressed differently
+    """
+    if compressions is None:
+        compressions = [None] * len(imgs)
+    # also the fallback of the image compressions that are not available
+    main_compression = (compression, compression_level)
+    description = xml_out.encode()
+    tile = (TIFF_TILE_SIZE, TIFF_TILE_SIZE)
+    # write to a temporary file first, so an interrupted run does not leave a truncated file that looks up to date
+    tmp_file_name = file_name + ".part"
+    try:
+        with tifffile.TiffWriter(tmp_file_name, bigtiff=True) as tif:
+            for img, img_compression in zip(imgs, compressions):
+                for block in img:
+                    # looked up per block because the arguments depend on the data type, which the cache makes cheap
+                    compression_args = get_tiff_compression_args(
+                        *(img_compression or main_compression), block.dtype.name, main_compression
+                    )
+                    tif.write(
+                        block,
+                        description=description,
+                        photometric="minisblack",
+                        metadata=None,  # keep tifffile from writing its own metadata next to the OME-XML
+                        # planes smaller than one tile are stored as strips instead of a single mostly padded tile
+                        tile=tile if min(block.shape[-2:]) >= TIFF_TILE_SIZE else None,
+                        maxworkers=maxworkers,
+                        **dict(compression_args)
+                    )
+                    description = None
+    except BaseException:
+        # also on KeyboardInterrupt: a partial file of possibly several GB would stay next to the data otherwise
+        try:
+            remove(tmp_file_name)
+        except OSError:  # e.g. the file could not be created in the first place
+            pass
+        raise
+    replace(tmp_file_name, file_name)
+
+
+def transform_tcf(
+    folder, overall_md, output_xml=False, phase_range=None, use_cache=False, compression=TIFF_COMPRESSION,
+    compression_level=TIFF_COMPRESSION_LEVEL, maxworkers=None, mip_compression=None, mip_compression_level=None
+):
     """Parse an image in a folder that has the same name as the folder
     and additionally ends with .TCF. The parsed OME-TIFF image is stored in the
     same folder. It loops over all imaging modalities contained in the TCF H5F
@@ -609,6 +1271,16 @@ def transform_tcf(folder, overall_md, output_xml=False):
     :param folder: Relative or absolute file path to folder containing image
     :param overall_md: Overall metadata dict
     :param output_xml: If True, output the ome-xml file alongside the ome-tiff file
+    :param phase_range: Optional tuple (lo, hi). If given, 2D phasemaps are rescaled from this range to uint16
+    instead of being stored as float, which many TIFF viewers cannot display
+    :param use_cache: If True, read the image from a re-chunked copy of the TCF file that is created on first use
+    and kept alongside it (see build_tcf_cache). Speeds up repeated conversions of the same image
+    :param compression: str: compression of the OME-TIFF (e.g. "zlib", "zstd") or "none", see write_ome_tiff
+    :param compression_level: int: compression level
+    :param maxworkers: int: maximum number of compression threads, see write_ome_tiff
+    :param mip_compression: str: optional compression of the maximum intensity projections (e.g. "none"), which are
+    small compared to the stacks. None compresses them like the other images
+    :param mip_compression_level: int: level of mip_compression, None for the default level of the codec
 
     """
 
@@ -616,204 +1288,325 @@ def transform_tcf(folder, overall_md, output_xml=False):
     try:
         exp_config_dict = read_image_config(folder)
     except Exception as e:
-        raise Exception("Skipping folder {} with Exception {}".format(folder, e))
+        raise Exception("Skipping folder {} with Exception {}".format(folder, e)) from e
 
     tiling_dict = read_tiling_info(folder)
 
     img_md = define_image_metadata(overall_md, exp_config_dict, tiling_dict)
-    # timestamp = get_img_timestamp(folder)
 
     # open HDF5 image (TCF)
     logging.info("Reading image")
-    dat = h5py.File(join(folder, basename(folder) + ".TCF"), "r")
     # file_name_store = join(top_folder, folder, folder + ".ome.tiff")
     file_name_store = join(folder, basename(folder) + ".ome.tiff")
     img_ome_xmls = []
     imgs = []
+    img_compressions = []
     plane_offset = 0  # for multiple timesteps / channels
-
-    keys_to_loop = list(dat["Data"].keys())
-    # FL channels are nested one level below imaging modalities --> (ugly) trick to achieve them in a similar way
-    if "2DFLMIP" in keys_to_loop:
-        n_chans = len(dat["Data"]["2DFLMIP"])
-        keys_to_loop.extend((n_chans-1)*["2DFLMIP"])
-        fl_mip_counter = 0
-    if "3DFL" in keys_to_loop:
-        n_chans = len(dat["Data"]["3DFL"])
-        keys_to_loop.extend((n_chans-1)*["3DFL"])
-        fl_3d_counter = 0
-
-    for i, name in enumerate(keys_to_loop):
-        logging.debug("Working on {}".format(name))
-        data_use = dat["Data"][name]
-        stagelabel = def_stagelabel(exp_config_dict["x_rec"], exp_config_dict["y_rec"], 0, 0, 0)
-
-        if name == "2DMIP":
-            channels = [img_md["channel_ht"].model_copy()]  # workaround for channel IDs
-            description = "2D Holotomography Maximum Intensity Projection"
-            data_type = "uint16"
-            img_formatted = np.array(
-                [data_use[item][()][np.newaxis] for item in data_use]
-            )[np.newaxis]
-            ann_ref = 1
-            timestamp = data_use["000000"].attrs["RecordingTime"][0].decode("utf-8")
-
-        elif name == "2D":
-            channels = [img_md["channel_ht"].model_copy()]  # workaround for channel IDs
-            description = "2D Phasemap"
-            data_type = "float"
-            img_formatted = np.array([data_use[item][()] for item in data_use])[
-                np.newaxis
-            ]
-            ann_ref = 1
-            timestamp = data_use["000000"].attrs["RecordingTime"][0].decode("utf-8")
-
-        elif name == "BF":
-            channels = [img_md["channel_bf"].model_copy()]  # workaround for channel IDs
-            description = "2D Brightfield"
-            data_type = "uint8"
-            img_formatted = np.array([data_use[item][0] for item in data_use])[
-                np.newaxis
-            ]
-            ann_ref = 2
-            timestamp = data_use["000000"].attrs["RecordingTime"][0].decode("utf-8")
-
-        elif name == "3D":
-            channels = [img_md["channel_ht"].model_copy()]  # workaround for channel IDs
-            description = "3D Holotomography"
-            data_type = "uint16"
-            img_formatted = np.array([data_use[item][()] for item in data_use])[
-                np.newaxis
-            ]
-            ann_ref = 1
-            timestamp = data_use["000000"].attrs["RecordingTime"][0].decode("utf-8")
-
-        elif name == "2DFLMIP":
-            channel = list(data_use.keys())[fl_mip_counter]
-
-            channels = [img_md["channel_fl{}".format(channel[2])].model_copy()]  # workaround for channel IDs]
-            description = "2D {} Maximum Intensity Projection"\
-                .format(img_md["channel_fl{}".format(channel[2])].name)
-            data_type = "uint16"
-            img_formatted = np.array(
-                [data_use[channel][item][()][np.newaxis] for item in data_use[channel]]
-            )[np.newaxis]
-            ann_ref = 3 + int(channel[2])
-            timestamp = data_use[channel]["000000"].attrs["RecordingTime"][0].decode("utf-8")
-
-            fl_mip_counter += 1
-
-        elif name == "3DFL":
-            channel = list(data_use.keys())[fl_3d_counter]
-
-            channels = [img_md["channel_fl{}".format(channel[2])].model_copy()]  # workaround for channel IDs
-            description = "3D {}".format(img_md["channel_fl{}".format(channel[2])].name)
-            data_type = "uint16"
-            img_formatted = np.array([data_use[channel][item][()] for item in data_use[channel]])[
-                np.newaxis
-            ]
-            ann_ref = 3 + int(channel[2])
-            timestamp = data_use[channel]["000000"].attrs["RecordingTime"][0].decode("utf-8")
-            stagelabel = def_stagelabel(
-                exp_config_dict["x_rec"],
-                exp_config_dict["y_rec"],
-                dat["Data"]["3DFL"].attrs["OffsetZ"],
-                dat["Data"]["3D"].attrs["ResolutionZ"] * dat["Data"]["3D"].attrs["SizeZ"],
-                dat["Data"]["3DFL"].attrs["ResolutionZ"] * dat["Data"]["3DFL"].attrs["SizeZ"]
+    # the images are read and written one after another, so they take turns using the same buffer memory instead of
+    # allocating (and page-faulting) new buffers for every image
+    scratch = {}
+    # the recording times are stored without time zone and are taken as local time (looked up once per TCF file)
+    tzinfo = datetime.now().astimezone().tzinfo
+
+    tcf_path = join(folder, basename(folder) + ".TCF")
+    if use_cache:
+        tcf_path = get_tcf_cache(tcf_path)
+
+    with open_tcf(tcf_path) as dat:
+        # FL channels are nested one level below the imaging modalities, so those get one task per channel
+        tasks = []
+        for name in sorted(dat["Data"].keys()):
+            if name in ("2DFLMIP", "3DFL"):
+                tasks.extend((name, channel) for channel in sorted(dat["Data"][name].keys()))
+            else:
+                tasks.append((name, None))
+
+        for i, (name, channel) in enumerate(tasks):
+            logging.debug("Working on {} {}".format(name, channel or ""))
+            # old TomoStudio versions do not write the counters, then the modality is parsed whenever it is present
+            counter_key = MODALITY_IMAGE_COUNTERS.get(name)
+            if counter_key in exp_config_dict and int(exp_config_dict[counter_key]) == 0:
+                logging.debug("Skipping {}, config.dat reports no images".format(name))
+                continue
+            if channel is not None and not is_fl_channel_enabled(exp_config_dict, channel[2]):
+                continue
+            reader = MODALITY_READERS.get(name)
+            if reader is None:
+                logging.info("Skipping unknown data type {}".format(name))
+                continue
+            data_use = dat["Data"][name]
+            # group with one dataset per timestep
+            timesteps = data_use if channel is None else data_use[channel]
+            # read all attributes at once instead of one HDF5 attribute access per value
+            attrs = dict(data_use.attrs)
+
+            channel_md, description, data_type, img_formatted, ann_ref = reader(
+                timesteps, channel, img_md, phase_range, scratch
             )
+            # the channel models are shared by all images, so each image gets a copy with its own channel ID (set in
+            # the copy instead of assigned afterwards, which would validate the assignment)
+            channels = [channel_md.model_copy(update={"id": "Channel:{}".format(i)})]
+            if name == "3DFL":
+                attrs_3d = dict(dat["Data"]["3D"].attrs)
+                stagelabel = def_stagelabel(
+                    exp_config_dict["x_rec"],
+                    exp_config_dict["y_rec"],
+                    attrs["OffsetZ"][0],
+                    attrs_3d["ResolutionZ"][0] * attrs_3d["SizeZ"][0],
+                    attrs["ResolutionZ"][0] * attrs["SizeZ"][0]
+                )
+            else:
+                stagelabel = def_stagelabel(exp_config_dict["x_rec"], exp_config_dict["y_rec"], 0, 0, 0)
 
-            fl_3d_counter += 1
-
-        else:
-            logging.info("Skipping unknown data type {}".format(name))
-            continue
-
-        channels[0].id = "Channel:{}".format(i)
+            timestamp = timesteps["000000"].attrs["RecordingTime"][0].decode("utf-8")
+            len_z = attrs["SizeZ"][0] if "SizeZ" in attrs else 1
 
-        try:
-            planes = [def_plane(
+            # the planes need the timestep from the tiling info, which is also when def_annotations adds the tiling
+            # annotation
+            if len(tiling_dict) > 0:
+                # the planes of one image only differ in the Z index
+                plane = def_plane(
                     exp_config_dict["x_rec"],
                     exp_config_dict["y_rec"],
                     exp_config_dict["z_rec"],
                     tiling_dict["tile_timestep"]*tiling_dict["tile_timestep_size"],
                     i,
                     tiling_dict["tile_timestep"],
-                    k
-                ) for k in range(img_formatted.shape[2])]
-            ann_refs = [0, ann_ref, 6]
-        except KeyError:
-            planes = []
-            ann_refs = [0, ann_ref]
-        # logging.warning("TIMESTAMP: {}".format(timestamp))
-
-        tzinfo = datetime.now().astimezone().tzinfo
-        dt = datetime.strptime(timestamp[:-4], '%Y-%m-%d %H:%M:%S').replace(tzinfo=tzinfo)
-        # logging.warning("dt = {}".format(dt))
+                    0
+                )
+                copy_plane = plane.model_copy
+                planes = [plane] + [copy_plane(update={"the_z": k}) for k in range(1, len_z)]
+                ann_refs = [0, ann_ref, 6]
+            else:
+                planes = []
+                ann_refs = [0, ann_ref]
+            # logging.warning("TIMESTAMP: {}".format(timestamp))
+
+            # RecordingTime is "YYYY-MM-DD HH:MM:SS.fff", the milliseconds are dropped
+            dt = datetime.fromisoformat(timestamp[:-4]).replace(tzinfo=tzinfo)
+            # logging.warning("dt = {}".format(dt))
+
+            try:
+                xml, plane_offset = build_ome_xml(
+                    attrs,
+                    plane_offset,
+                    channels,
+                    dt,
+                    description,
+                    img_md["exp"],
+                    overall_md["exper"],
+                    img_md["instr"],
+                    stagelabel,
+                    data_type,
+                    ["Annotation:{}".format(item) for item in ann_refs],
+                    planes,
+                    i
+                )
+            except Exception as e:
+                raise Exception("Exception during xml building in {}: {}".format(folder, e)) from e
+
+            img_ome_xmls.append(xml)
+            imgs.append(img_formatted)
+            if mip_compression is not None and name in MIP_MODALITIES:
+                img_compressions.append((mip_compression, mip_compression_level))
+            else:
+                img_compressions.append(None)
+
+        # all children are already validated models, so the root is built without a second validation pass
+        # (OME.__init__ walks the whole tree again to collect ids and link references, which to_xml does not need)
+        ome_xmls = model.OME.model_construct(
+            creator="tcf_to_ometiff by Henning Zwirnmann v0.5.1",
+            images=img_ome_xmls,
+            experiments=[img_md["exp"]],
+            experimenters=[overall_md["exper"]],
+            instruments=[img_md["instr"]],
+            structured_annotations=model.StructuredAnnotations(map_annotations=img_md["anns"])
+        )
+
+        # serialize once (xsdata renders through lxml) and reuse the string for the OME-TIFF and the sidecar file
+        xml_out = serialize_ome(ome_xmls)
 
+        # the pixel data is only read from the TCF while writing, one timestep ahead of the writer
+        logging.info("Writing file {}".format(file_name_store))
         try:
-            xml, plane_offset = build_ome_xml(
-                data_use,
-                plane_offset,
-                channels,
-                dt,
-                description,
-                img_md["exp"],
-                overall_md["exper"],
-                img_md["instr"],
-                stagelabel,
-                data_type,
-                ["Annotation:{}".format(item) for item in ann_refs],
-                planes
+            write_ome_tiff(
+                file_name_store, imgs, xml_out, compression, compression_level, maxworkers, img_compressions
             )
-        except Exception as e:
-            raise Exception("Exception during xml building: {}".format(e))
-
-        img_ome_xmls.append(xml)
-        imgs.append(img_formatted)
-
-    ome_xmls = model.OME(
-        creator="tcf_to_ometiff by Henning Zwirnmann v0.5.1",
-        images=img_ome_xmls,
-        experiments=[img_md["exp"]],
-        experimenters=[overall_md["exper"]],
-        instruments=[img_md["instr"]],
-        structured_annotations=img_md["anns"]
-    )
-
-    logging.info("Writing file {}".format(file_name_store))
-    writers.OmeTiffWriter.save(
-        imgs,
-        file_name_store,
-        ome_xml=ome_xmls,
-    )
+        finally:
+            # stop the background readers (see prefetch_blocks) before the TCF file is closed, also if writing failed
+            for img in imgs:
+                img.close()
 
     if output_xml:
-        xml_out = ome_xmls.to_xml()
         with open(join(folder, basename(folder) + ".ome.xml"), "w") as fn:
             fn.write(xml_out)
 
 
-def transform_folder(top_folder, basic_config_path, output_xml=False):
+def is_converted(folder):
+    """Check whether the OME-TIFF in an image folder exists and is at least as new as the TCF file.
+
+    :param folder: Relative or absolute file path to folder containing image
+    :return: True if the TCF does not need to be parsed again
+    """
+    folder = folder.rstrip("/")
+    try:
+        return getmtime(join(folder, basename(folder) + ".ome.tiff")) >= \
+            getmtime(join(folder, basename(folder) + ".TCF"))
+    except OSError:
+        return False
+
+
+def transform_folder_worker(
+    top_folder, folder, overall_md, output_xml, force=False, phase_range=None, use_cache=False,
+    compression=TIFF_COMPRESSION, compression_level=TIFF_COMPRESSION_LEVEL, maxworkers=None, mip_compression=None,
+    mip_compression_level=None
+):
+    """Process pool worker for transform_folder: parse the image in one subfolder and log instead of raising
+    exceptions, so a single broken folder does not abort the whole batch.
+
+    :param top_folder: Relative or absolute file path to folder containing image folders
+    :param folder: Name of the subfolder containing the image
+    :param overall_md: Overall metadata dict
+    :param output_xml: If True, output the ome-xml file alongside the ome-tiff file
+    :param force: If True, parse the image even if its OME-TIFF is up to date
+    :param phase_range: Optional tuple (lo, hi) to rescale 2D phasemaps to uint16, see transform_tcf
+    :param use_cache: If True, read the image from a re-chunked copy of the TCF file, see transform_tcf
+    :param compression: str: compression of the OME-TIFF, see transform_tcf
+    :param compression_level: int: compression level
+    :param maxworkers: int: maximum number of compression threads, see write_ome_tiff
+    :param mip_compression: str: optional compression of the maximum intensity projections, see transform_tcf
+    :param mip_compression_level: int: level of mip_compression, see transform_tcf
+    :return: True if the image was parsed or its OME-TIFF is up to date, False if parsing failed
+
+    """
+    if not force and is_converted(join(top_folder, folder)):
+        logging.info("Skipping folder {}, OME-TIFF is up to date".format(folder))
+        return True
+    logging.info("Reading folder {}".format(folder))
+    try:
+        transform_tcf(
+            join(top_folder, folder), overall_md, output_xml, phase_range, use_cache, compression, compression_level,
+            maxworkers, mip_compression, mip_compression_level
+        )
+    except Exception:
+        # with the traceback of the original exception, which transform_tcf chains to its own
+        logging.exception("Failed folder {}".format(folder))
+        return False
+    return True
+
+
+def transform_folder(
+    top_folder, basic_config_path, output_xml=False, processes=None, use_threads=False, force=False,
+    phase_range=None, use_cache=False, compression=TIFF_COMPRESSION, compression_level=TIFF_COMPRESSION_LEVEL,
+    mip_compression=None, mip_compression_level=None
+):
     """Parse images stored in subfolders of a top folder. This is the
     standard TomoStudio case when on each date a new top folder is created that
     has one subfolder for each snapshot. The parsed OME-TIFF images are stored
-    in the respective subfolders.
+    in the respective subfolders. The subfolders are independent of each other
+    and are processed in parallel by a pool of worker processes or, with
+    use_threads, by two threads of the current process.
+
+    With the spawn and forkserver start methods (the defaults on macOS and Windows and, from Python 3.14 on, on
+    Linux), the worker processes import the calling script again, so scripts calling transform_folder need an
+    ``if __name__ == "__main__":`` guard. With a single worker (processes=1, one folder or one CPU), the folders are
+    parsed one after another in the current process.
 
     :param top_folder: Relative or absolute file path to folder containing image
     :param basic_config_path: Relative or absolute file path to csv file with basic metadata
     :param output_xml: If True, output the ome-xml file alongside the ome-tiff file
+    :param processes: Maximum number of worker processes (default and 0: number of CPUs)
+    :param use_threads: If True, use two threads instead of worker processes. This overlaps the OME-TIFF compression
+    of one folder with the HDF5 reads of the next one without the memory cost of several processes
+    :param force: If True, also parse folders whose OME-TIFF is newer than the TCF file (skipped by default)
+    :param phase_range: Optional tuple (lo, hi) to rescale 2D phasemaps to uint16, see transform_tcf
+    :param use_cache: If True, read the images from re-chunked copies of the TCF files, see transform_tcf
+    :param compression: str: compression of the OME-TIFFs (e.g. "zlib", "zstd") or "none", see transform_tcf
+    :param compression_level: int: compression level
+    :param mip_compression: str: optional compression of the maximum intensity projections, see transform_tcf
+    :param mip_compression_level: int: level of mip_compression, see transform_tcf
+    :return: list of the subfolders that could not be parsed
 
     """
+    if processes is not None and processes < 0:
+        raise ValueError("processes must not be negative, got {}".format(processes))
     overall_md = create_overall_config(basic_config_path)
 
     logging.info("Traversing folders in {}".format(top_folder))
-    folders = [d for d in listdir(top_folder) if isdir(join(top_folder, d))]
-    for folder in folders:
-        print(folder)
-        logging.info("Reading folder {}".format(folder))
-        try:
-            transform_tcf(join(top_folder, folder), overall_md, output_xml)
-        except Exception as e:
-            print(e)
-            logging.info(e)
-            continue
+    # scandir entries carry the file type from the directory listing, which saves one stat() call per entry
+    with scandir(top_folder) as entries:
+        folders = [entry.name for entry in entries if entry.is_dir()]
+    if len(folders) == 0:
+        return []
+
+    if use_threads:
+        # h5py holds its global lock while reading, but tifffile releases the GIL while compressing, so one thread can
+        # read the next folder while the other one compresses and writes
+        n_workers = 2
+    else:
+        # HDF5 serializes access within one process, so use processes instead of threads
+        n_workers = min(len(folders), processes or cpu_count() or 1)
+    # a single worker process would only add its start-up time, so then the folders are parsed in this process
+    in_process = use_threads or n_workers == 1
+
+    if in_process and phase_range is not None:
+        # start numba's threading layer in the main thread, see get_rescale_kernel
+        get_rescale_kernel()
+
+    executor_class = ThreadPoolExecutor if in_process else ProcessPoolExecutor
+    # share the CPUs between the workers' tile compression threads instead of letting each worker start its own set
+    maxworkers = max(1, (cpu_count() or 1) // n_workers)
+
+    failed = []
+    pending = folders
+    pool_size = n_workers
+    n_done = 0
+    while len(pending) > 0:
+        broken = set()
+        with executor_class(max_workers=min(len(pending), pool_size)) as executor:
+            futures = {
+                executor.submit(
+                    transform_folder_worker, top_folder, folder, overall_md, output_xml, force, phase_range,
+                    use_cache, compression, compression_level, maxworkers, mip_compression, mip_compression_level
+                ): folder for folder in pending
+            }
+            for future in as_completed(futures):
+                folder = futures[future]
+                try:
+                    converted = future.result()
+                except BrokenProcessPool:
+                    # a worker process died (e.g. killed for running out of memory), which fails all unfinished
+                    # folders of the pool, not only the one it was parsing
+                    broken.add(folder)
+                    continue
+                except Exception:  # the worker itself logs parser errors, this is e.g. an unpicklable result
+                    logging.exception("Failed folder {}".format(folder))
+                    converted = False
+                n_done += 1
+                if converted:
+                    logging.info("Finished folder {} ({}/{})".format(folder, n_done, len(folders)))
+                else:
+                    failed.append(folder)
+
+        # in the order of submission: a pool of one process parses the folders one after another, so there the first
+        # unfinished folder is the one whose worker died
+        pending = [folder for folder in pending if folder in broken]
+        if len(pending) == 0:
+            break
+        if pool_size == 1:
+            n_done += 1
+            logging.error("Failed folder {} ({}/{}), the worker process died".format(pending[0], n_done, len(folders)))
+            failed.append(pending.pop(0))
+            pool_size = n_workers
+        elif len(pending) < len(futures):
+            logging.warning("A worker process died, parsing the {} unfinished folders again".format(len(pending)))
+        else:
+            # no folder was finished, so retrying in parallel could fail all of them again
+            logging.warning(
+                "A worker process died, parsing the {} unfinished folders one after another".format(len(pending))
+            )
+            pool_size = 1
+
+    if len(failed) > 0:
+        logging.error("Failed to parse {} of {} folders: {}".format(len(failed), len(folders), ", ".join(failed)))
+    return failed